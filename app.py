@@ -34,21 +34,45 @@
 # - **NEW**: Implemented post-processing logic to ensure "Accumulated deficit" and "Accumulated surplus" are mutually exclusive per year.
 # - **REMOVED**: Document Refinement Tool and all associated functions and routes.
 # - **HEROKU READY**: Modified app.run() to use Heroku's assigned PORT.
+# - OCR and Gemini calls for multi-file uploads run concurrently.
+# - The Gemini extraction rules are sent as the model's system instruction.
+# - OCR text is split into statement/notes sections; only numeric sections are sent to Gemini.
+# - Large PDFs are OCR'd through Vision's asynchronous API via a GCS bucket (OCR_GCS_BUCKET).
+# - Born-digital PDFs are parsed locally from their text layer when reliable (PDF_HANDLING=auto).
 
 import os
-import io
 import re
 import json
-import requests
+import orjson
 import logging
-import copy
+import datetime
+import difflib
+import hashlib
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import suppress
+from functools import cache, lru_cache, wraps
+from itertools import chain
+from types import MappingProxyType
+from urllib.parse import quote
 from flask import Flask, request, jsonify, send_file
+from flask.json.provider import DefaultJSONProvider
+from flask_compress import Compress
 from flask_cors import CORS
-from google.cloud import vision
+from google.api_core import exceptions as api_exceptions, retry
+from google.cloud import storage, vision
 from dotenv import load_dotenv
 import google.generativeai as genai
+import pymupdf
 from openpyxl import Workbook
-from openpyxl.styles import Font, Border, Side, Alignment, PatternFill, numbers
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles.fonts import DEFAULT_FONT
+from openpyxl.styles import Font, Border, Side, Alignment, PatternFill, NamedStyle, numbers
 from openpyxl.utils import get_column_letter
 
 
@@ -58,8 +82,27 @@ load_dotenv()
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Serves Flask's JSON (jsonify, request.get_json) through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
-CORS(app)
+app.json = OrjsonProvider(app)
+# Compress JSON/text responses only; the xlsx download is already a deflated zip archive.
+# The bodies are small error payloads, so a low level keeps CPU cost negligible.
+app.config['COMPRESS_MIMETYPES'] = ['application/json', 'text/plain']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_LEVEL'] = 4
+app.config['COMPRESS_BR_LEVEL'] = 4
+Compress(app)
+# Names of uploads that could not be converted, sent with an otherwise successful workbook.
+FAILED_FILES_HEADER = 'X-Failed-Files'
+CORS(app, expose_headers=[FAILED_FILES_HEADER])
 
 # Heroku provides a temporary filesystem, so UPLOAD_FOLDER and OUTPUT_FOLDER
 # are not strictly necessary to create persistent directories, but good for local dev.
@@ -70,8 +113,50 @@ os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
+# OCR text and parsed Gemini output are cached here, keyed by a hash of their inputs.
+CACHE_FOLDER = os.path.join(OUTPUT_FOLDER, 'cache')
+os.makedirs(CACHE_FOLDER, exist_ok=True)
+# Number of cached results per function also kept in memory.
+MEMORY_CACHE_SIZE = 128
+# Cached results older than this are recomputed, so model or prompt drift is eventually picked up.
+CACHE_MAX_AGE = datetime.timedelta(days=30)
+# Size cap for CACHE_FOLDER; the oldest entries are deleted once a write pushes it over. The
+# folder is checked at most once per CACHE_SWEEP_INTERVAL seconds per process.
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_MB", "512")) * 1024 * 1024
+CACHE_SWEEP_INTERVAL = 600
+# Block size used when hashing uploaded files.
+UPLOAD_READ_CHUNK_SIZE = 1024 * 1024
+# File extensions accepted for conversion, compared case-insensitively.
+PDF_EXTENSIONS = frozenset({'.pdf'})
+# PDF header, which readers accept anywhere within the first PDF_SIGNATURE_WINDOW bytes.
+PDF_SIGNATURE = b'%PDF-'
+PDF_SIGNATURE_WINDOW = 1024
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+# 'auto' parses born-digital PDFs from their own text layer when that works reliably and
+# only sends scans/unusual layouts through OCR + Gemini; 'vision' always uses OCR + Gemini.
+PDF_HANDLING = os.getenv("PDF_HANDLING", "auto").lower()
+# Share of numeric lines that must parse, and the minimum number of items, to trust a local parse.
+LOCAL_PARSE_MIN_CONFIDENCE = 0.7
+LOCAL_PARSE_MIN_ROWS = 5
+# Text-layer line reconstruction, as fractions of a word's box height: baselines closer
+# than LOCAL_LINE_TOLERANCE share a line, gaps wider than LOCAL_COLUMN_GAP separate columns.
+# An amount column must be centred within half a column spacing of its header year.
+LOCAL_LINE_TOLERANCE = 0.3
+LOCAL_COLUMN_GAP = 0.5
+# Lines ending in more amount-like tokens than this are not statement rows (e.g. number tables).
+LOCAL_MAX_AMOUNT_TOKENS = 20
+
+# Upper bound on concurrent Gemini requests for a single upload.
+GEMINI_MAX_CONCURRENCY = 8
+# Document sections are packed into chunks of at most this many characters per Gemini call.
+GEMINI_SECTION_CHUNK_CHARS = 20000
+# Sections with fewer amount-like numbers than this (cover pages, contents, narrative) are not sent.
+MIN_SECTION_AMOUNTS = 5
+# Documents that fit in one chunk of at most this many characters are parsed together, up to
+# GEMINI_BATCH_MAX_DOCS per call and GEMINI_SECTION_CHUNK_CHARS in total, saving round trips.
+GEMINI_BATCH_DOC_MAX_CHARS = 6000
+GEMINI_BATCH_MAX_DOCS = 8
 
 if not GEMINI_API_KEY:
     logger.error("Error: GEMINI_API_KEY is not set. Cannot call Gemini API.")
@@ -81,7 +166,55 @@ if not GEMINI_API_KEY:
 else:
     genai.configure(api_key=GEMINI_API_KEY)
 
-vision_client = vision.ImageAnnotatorClient()
+# Every Gemini call goes to this model, and cached responses are keyed on it. The system
+# instruction and report structure (~2k tokens) are far below the context-cache minimum
+# (32k tokens for gemini-1.5-flash), so they are sent inline with each request.
+GEMINI_MODEL_NAME = 'gemini-1.5-flash-latest'
+# Rate limiting and transient server errors are retried with jittered exponential backoff
+# (1s, 2s, 4s ... capped at 30s) for up to GEMINI_RETRY_DEADLINE seconds per call.
+GEMINI_REQUEST_TIMEOUT = 120
+GEMINI_RETRY_DEADLINE = 300
+GEMINI_RETRY = retry.Retry(
+    predicate=retry.if_exception_type(
+        api_exceptions.ResourceExhausted,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.InternalServerError,
+        api_exceptions.DeadlineExceeded,
+    ),
+    initial=1.0,
+    maximum=30.0,
+    multiplier=2.0,
+    timeout=GEMINI_RETRY_DEADLINE,
+)
+
+SYSTEM_INSTRUCTION = """
+You are an expert financial data extractor. Your task is to extract all financial line items and their corresponding numerical values from the provided text.
+- The output must be a valid JSON array of objects.
+- Each object must have two keys: "Description" (string) and "AmountsByYear" (an object).
+- The "AmountsByYear" object should have years as keys (e.g., "2023") and numerical values as values.
+- Parse numbers correctly: remove currency symbols, commas, and handle parentheses for negative numbers. Treat spaces as thousand separators (e.g., "1 234" is 1234).
+- Do NOT calculate or infer any values. Only extract what is explicitly present in the text.
+- Extract data from all sections, including main statements and notes.
+- Example output format: [{"Description": "Revenue", "AmountsByYear": {"2023": 500000, "2022": 450000}}]
+"""
+
+# Number of PDFs read/OCR'd concurrently for a single upload.
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "8"))
+# Upper bound on in-flight Vision OCR calls across all requests in this process, so
+# concurrent uploads on a threaded worker stay within the Vision quota together.
+VISION_MAX_CONCURRENCY = 16
+_vision_slots = threading.BoundedSemaphore(VISION_MAX_CONCURRENCY)
+
+# Optional bucket for asynchronous OCR. The synchronous API takes the PDF inline and
+# only annotates its first few pages, so large PDFs are staged in GCS when this is set.
+OCR_GCS_BUCKET = os.getenv("OCR_GCS_BUCKET", "")
+# PDFs larger than this, or with more pages than one inline request covers, use the
+# asynchronous API (when a bucket is configured).
+ASYNC_OCR_MIN_BYTES = 5 * 1024 * 1024
+# Vision annotates at most this many pages of a PDF sent inline in one request.
+INLINE_OCR_MAX_PAGES = 5
+ASYNC_OCR_PAGES_PER_SHARD = 20
+ASYNC_OCR_TIMEOUT = 300
 
 # --- Canonical Descriptions Mapping (Existing) ---
 CANONICAL_DESCRIPTIONS = {
@@ -227,38 +360,404 @@ MASTER_STRUCTURE = {
     }
 }
 
+# The layout is shared by every request, so freeze it: requests can rely on a single
+# reference without taking defensive copies.
+MASTER_STRUCTURE = MappingProxyType({
+    category: MappingProxyType({subcategory: tuple(items) for subcategory, items in subcategories.items()})
+    for category, subcategories in MASTER_STRUCTURE.items()
+})
+
+# --- Excel Report Layout ---
+_CURRENCY_FORMAT = '_(* #,##0.00_);_(* (#,##0.00);_(* "-"??_);_(@_)'
+_BOLD_FONT = Font(bold=True)
+_TOTAL_BORDER = Border(bottom=Side(style='thin'), top=Side(style='thin'))
+
+# Named styles registered once on each report workbook; cells reference them by name
+# instead of carrying their own font/fill/border/alignment/format. NamedStyle objects
+# are bound to a single workbook, so only their definitions are shared between requests.
+_NAMED_STYLE_SPECS = (
+    ('fin_header', dict(
+        font=Font(bold=True, color="FFFFFF"),
+        fill=PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid"),
+        alignment=Alignment(horizontal='center')
+    )),
+    ('fin_category', dict(font=_BOLD_FONT)),
+    ('fin_subcategory', dict(font=_BOLD_FONT, alignment=Alignment(indent=1))),
+    ('fin_item', dict(font=DEFAULT_FONT, alignment=Alignment(indent=2))),
+    ('fin_currency', dict(font=DEFAULT_FONT, number_format=_CURRENCY_FORMAT)),
+    ('fin_total', dict(font=_BOLD_FONT, border=_TOTAL_BORDER, alignment=Alignment(indent=2))),
+    ('fin_total_currency', dict(font=_BOLD_FONT, border=_TOTAL_BORDER, number_format=_CURRENCY_FORMAT)),
+)
+
+# Row kinds in the report plan below.
+_CATEGORY_ROW, _SUBCATEGORY_ROW, _ITEM_ROW, _BLANK_ROW = range(4)
+
+def _build_row_plan():
+    """
+    Flattens MASTER_STRUCTURE into (kind, label style, value style, name) rows in report order.
+    Total rows are identified here once, so the writer never inspects item names.
+    """
+    plan = []
+    for category, subcategories in MASTER_STRUCTURE.items():
+        plan.append((_CATEGORY_ROW, 'fin_category', None, category))
+        for subcategory, items in subcategories.items():
+            # 'N/A' groups (including uniquely keyed ones like 'N/A_2') have no header row
+            if not subcategory.startswith("N/A"):
+                plan.append((_SUBCATEGORY_ROW, 'fin_subcategory', None, subcategory))
+            for item_name in items:
+                if "total" in item_name.lower():
+                    plan.append((_ITEM_ROW, 'fin_total', 'fin_total_currency', item_name))
+                else:
+                    plan.append((_ITEM_ROW, 'fin_item', 'fin_currency', item_name))
+        # Blank row between major categories for readability
+        plan.append((_BLANK_ROW, None, None, None))
+    return tuple(plan)
+
+_ROW_PLAN = _build_row_plan()
+
+# --- Precompiled Lookups ---
+# Built once at import so the per-item helpers below do a single pass each.
+_NUM_RE = re.compile(r'[^\d.\-]')
+# The same scrub as _NUM_RE as a str.translate table: every Latin-1 character other than
+# 0-9, '.' and '-' is deleted, plus the non-Latin-1 spaces/symbols common in amounts. The
+# Unicode minus sign is kept as '-' so "\u22121 234" stays negative.
+_NUM_DELETE_TABLE = str.maketrans({
+    **dict.fromkeys(
+        (char for char in map(chr, range(256)) if not ('0' <= char <= '9' or char in '.-')), None
+    ),
+    **dict.fromkeys('\u2009\u202f\u20ac', None),
+    '\u2212': '-',
+})
+_OCR_SHARD_RE = re.compile(r'output-(\d+)-to-\d+\.json$')
+# Headings that open a financial statement or the notes; OCR text is a single line,
+# so they are matched inline.
+_SECTION_RE = re.compile(
+    r'\b(?:Statement of (?:Financial Position|Comprehensive Income|Changes in (?:Equity|Net Assets)|Cash Flows)'
+    r'|(?:Detailed )?Income Statement|Balance Sheet|Notes to the (?:Annual )?Financial Statements)',
+    re.IGNORECASE
+)
+# Runs of three or more digits: amounts (including each group of "1 234 567") and years.
+_AMOUNT_RE = re.compile(r'\d{3,}')
+# Local text-layer parsing: one amount column ("1 234", "(1,234.00)", "2015", "-"), one word
+# of an amount ("(1", "234.00)"), and a year token. Statement rows are a digit-free
+# description followed by amount words, which are checked word by word rather than with one
+# regex over the whole line, so no input can make the match backtrack.
+_LOCAL_AMOUNT_RE = re.compile(r'\(?-?(?:(?:0|[1-9]\d{0,2})(?:[ ,]\d{3})*|[1-9]\d{3,})(?:\.\d{1,2})?\)?|-')
+_LOCAL_AMOUNT_TOKEN_RE = re.compile(r'\(?-?\d+(?:,\d{3})*(?:\.\d{1,2})?\)?|-')
+_LOCAL_DESCRIPTION_RE = re.compile(r'[A-Za-z)]')
+_DIGIT_RE = re.compile(r'\d')
+_NOTE_REF_RE = re.compile(r'\d{1,2}')
+_YEAR_TOKEN_RE = re.compile(r'(?:19|20)\d{2}')
+# Words that may precede the years of a column header ("Figures in Rand  Note(s)  2023  2022").
+_YEAR_HEADER_WORD_RE = re.compile(
+    r"\(?(?:figures|in|rands?|r|zar|usd|notes?|note\(s\)|restated|audited|unaudited|group|company"
+    r"|r'000|'000|[$\u20ac\u00a3])\)?[.:]?",
+    re.IGNORECASE
+)
+# Typographic punctuation NFKC leaves alone, folded to the ASCII forms the vocabulary uses.
+_PUNCTUATION_TABLE = str.maketrans({
+    '\u2018': "'", '\u2019': "'", '\u201c': '"', '\u201d': '"',
+    '\u2010': '-', '\u2011': '-', '\u2013': '-', '\u2014': '-', '\u2212': '-',
+})
+_CANON_LOWER = {k.lower().strip(): v for k, v in CANONICAL_DESCRIPTIONS.items()}
+# Names that are already canonical (every mapping target and report line item). Gemini is
+# asked to use these, so most descriptions are returned as-is after one set lookup.
+_KNOWN_CANONICALS = frozenset(chain(
+    CANONICAL_DESCRIPTIONS.values(),
+    (item for subcategories in MASTER_STRUCTURE.values() for items in subcategories.values() for item in items)
+))
+# Fallback for near-miss descriptions (OCR typos, plurals, stray punctuation): every synonym
+# and report line item, bucketed by first letter so a miss is only compared with a handful
+# of candidates instead of the whole vocabulary.
+def _build_fuzzy_buckets():
+    buckets = defaultdict(dict)
+    for term, canonical in _CANON_LOWER.items():
+        buckets[term[:1]][term] = canonical
+    for subcategories in MASTER_STRUCTURE.values():
+        for items in subcategories.values():
+            for item in items:
+                buckets[item.lower()[:1]].setdefault(item.lower(), item)
+    return dict(buckets)
+
+_CANON_FUZZY_BUCKETS = _build_fuzzy_buckets()
+# Similarity (difflib ratio) a near-miss needs; the closest distinct vocabulary pair
+# ("garage levies"/"garbage levies") scores 0.96, so ambiguous matches are also rejected.
+CANON_FUZZY_CUTOFF = 0.9
+
 # --- Utility Functions ---
 
+def normalize_text(text):
+    """
+    Canonicalises extracted text in one pass: NFKC (non-breaking and thin spaces, ligatures,
+    full-width forms), ASCII quotes and dashes, then whitespace runs collapsed to single spaces.
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).translate(_PUNCTUATION_TABLE).split())
+
+# The same descriptions and amount strings recur across years and files, and both
+# helpers are pure, so their results are memoised.
+
 def get_canonical_name(name):
     """Finds the canonical name for a given financial term."""
-    return CANONICAL_DESCRIPTIONS.get(name.lower().strip(), name)
+    # Gemini occasionally returns a number or null as a description; those pass through as-is,
+    # as do names that are canonical already
+    if not isinstance(name, str) or name in _KNOWN_CANONICALS:
+        return name
+    return _canonical_name(name)
+
+@lru_cache(maxsize=4096)
+def _canonical_name(name):
+    """Memoised on the raw description, so repeats skip the strip()/lower() normalisation too."""
+    key = name.strip()
+    # Unicode normalisation and casefold() only matter (and only cost extra) for non-ASCII text
+    key = key.lower() if key.isascii() else normalize_text(key).casefold()
+    canonical = _CANON_LOWER.get(key)
+    if canonical is None:
+        canonical = _fuzzy_canonical_name(key)
+    return canonical if canonical is not None else name
+
+def _fuzzy_canonical_name(key):
+    """Returns the one canonical name a description nearly matches, or None."""
+    bucket = _CANON_FUZZY_BUCKETS.get(key[:1])
+    if not bucket:
+        return None
+    matches = {bucket[term] for term in difflib.get_close_matches(key, bucket, n=3, cutoff=CANON_FUZZY_CUTOFF)}
+    return matches.pop() if len(matches) == 1 else None
 
 def clean_value(value):
     """Cleans and converts a string value to a float, handling various formats."""
     if isinstance(value, (int, float)):
         return float(value)
     if isinstance(value, str):
-        value = value.strip()
-        # Handle negative values in parentheses
-        is_negative = value.startswith('(') and value.endswith(')')
-        # Remove non-numeric characters except for a single decimal point
-        value = re.sub(r'[^\d.]', '', value)
-        if value:
-            try:
-                numeric_value = float(value)
-                return -numeric_value if is_negative else numeric_value
-            except ValueError:
-                return None
+        return _clean_numeric_string(value)
     return None
 
+@lru_cache(maxsize=4096)
+def _clean_numeric_string(value):
+    """Converts a formatted amount string to a float, or None if it holds no number."""
+    value = value.strip()
+    # Plain digit runs (the common case in Gemini's JSON) need no scrubbing
+    if value.isascii() and value.isdigit():
+        return float(value)
+    # Handle negative values in parentheses
+    is_negative = value[:1] == '(' and value[-1:] == ')'
+    # Remove non-numeric characters, keeping the decimal point and minus sign
+    value = value.translate(_NUM_DELETE_TABLE)
+    if not value.isascii():
+        value = _NUM_RE.sub('', value)
+    # A leading or trailing minus ('-1,234', '1,234-') also marks a negative value; one shown
+    # both ways, like '(-5)', is still only negated once
+    if value[:1] == '-' or value[-1:] == '-':
+        is_negative = True
+        value = value.strip('-')
+    if value:
+        try:
+            numeric_value = float(value)
+            return -numeric_value if is_negative else numeric_value
+        except ValueError:
+            return None
+    return None
+
+# --- Response Caching ---
+
+_cache_sweep_lock = threading.Lock()
+_cache_swept_at = 0.0
+
+def prune_cache_folder():
+    """
+    Deletes expired CACHE_FOLDER entries, then the oldest ones until the folder is back under
+    CACHE_MAX_BYTES. Runs at most once per CACHE_SWEEP_INTERVAL, and a caller never waits for
+    another's sweep.
+    """
+    global _cache_swept_at
+    if time.time() - _cache_swept_at < CACHE_SWEEP_INTERVAL or not _cache_sweep_lock.acquire(blocking=False):
+        return
+    try:
+        _cache_swept_at = time.time()
+        entries = []
+        with os.scandir(CACHE_FOLDER) as scan:
+            for entry in scan:
+                if entry.name.endswith('.json'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        expired_before = time.time() - CACHE_MAX_AGE.total_seconds()
+        for written_at, size, path in sorted(entries):
+            if written_at >= expired_before and total_size <= CACHE_MAX_BYTES:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            total_size -= size
+    except OSError as e:
+        logger.warning(f"Could not prune cache folder: {e}")
+    finally:
+        _cache_sweep_lock.release()
+
+def _is_empty_result(result):
+    # (parsed_data, text_content) pairs count as empty when both sides are
+    return not result or (isinstance(result, tuple) and not any(result))
+
+def content_cache(namespace, key_func):
+    """
+    Memoises a function's JSON-serialisable result under a SHA-256 key of its inputs.
+    Hot keys are served from a small in-process LRU; everything else is read from
+    CACHE_FOLDER, so re-uploading the same PDF skips OCR and Gemini entirely.
+    Empty results are not cached, as they usually mean a transient failure, and entries
+    expire CACHE_MAX_AGE after they were written. The folder is kept under CACHE_MAX_BYTES.
+    """
+    max_age = CACHE_MAX_AGE.total_seconds()
+
+    def decorator(func):
+        memory = OrderedDict()
+        lock = threading.Lock()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            key = hashlib.sha256(key_func(*args, **kwargs)).hexdigest()
+            now = time.time()
+            with lock:
+                if key in memory:
+                    written_at, result = memory[key]
+                    if now - written_at <= max_age:
+                        memory.move_to_end(key)
+                        return result
+                    del memory[key]
+
+            path = os.path.join(CACHE_FOLDER, f"{namespace}-{key}.json")
+            try:
+                with open(path, 'rb') as f:
+                    written_at = os.fstat(f.fileno()).st_mtime
+                    expired = now - written_at > max_age
+                    if not expired:
+                        result = orjson.loads(f.read())
+                if expired:
+                    # Stale entries are deleted, not just skipped, so they do not pile up on disk
+                    with suppress(FileNotFoundError):
+                        os.remove(path)
+                    raise FileNotFoundError(path)
+                logger.info(f"Loaded cached {namespace} result {key[:12]}.")
+            except (OSError, ValueError):
+                result = func(*args, **kwargs)
+                if _is_empty_result(result):
+                    return result
+                # Write to a temporary file first so concurrent readers never see a partial entry.
+                # A failed write only loses the cache entry, never the computed result.
+                written_at = time.time()
+                try:
+                    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=CACHE_FOLDER)
+                    try:
+                        with open(fd, 'wb') as f:
+                            f.write(orjson.dumps(result))
+                        os.replace(tmp_path, path)
+                    except BaseException:
+                        with suppress(OSError):
+                            os.remove(tmp_path)
+                        raise
+                except OSError as e:
+                    logger.warning(f"Could not write cached {namespace} result {key[:12]}: {e}")
+                prune_cache_folder()
+
+            with lock:
+                memory[key] = (written_at, result)
+                if len(memory) > MEMORY_CACHE_SIZE:
+                    memory.popitem(last=False)
+            return result
+        return wrapper
+    return decorator
+
+def _pdf_cache_key(pdf_file):
+    # Hash the upload in chunks so computing the key never needs the whole PDF in memory.
+    # The handling mode is part of the key, as it decides whether the text layer is parsed.
+    digest = hashlib.sha256(PDF_HANDLING.encode() + b"\0")
+    for chunk in iter(lambda: pdf_file.read(UPLOAD_READ_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    pdf_file.seek(0)
+    return digest.digest()
+
+def _gemini_cache_key(text_content, filename, custom_prompt_text=""):
+    # The filename does not affect the parse; the model and instruction do.
+    return "\0".join([
+        GEMINI_MODEL_NAME, SYSTEM_INSTRUCTION, custom_prompt_text, text_content
+    ]).encode()
+
+def _gemini_batch_cache_key(texts, custom_prompt_text=""):
+    return "\0".join([
+        GEMINI_MODEL_NAME, SYSTEM_INSTRUCTION, custom_prompt_text, *texts
+    ]).encode()
+
 # --- Core Processing Functions ---
 
-def extract_text_from_pdf(pdf_content):
-    """Extracts text from a PDF file's content using Google Cloud Vision API."""
-    if not vision_client:
-        raise ConnectionError("Google Cloud Vision client is not initialized.")
-    
+# API clients are created on first use rather than at import, so app start-up (and every
+# gunicorn worker boot) does not pay for credential discovery and channel setup.
+@cache
+def get_vision_client():
+    return vision.ImageAnnotatorClient()
+
+@cache
+def get_storage_client():
+    return storage.Client()
+
+def extract_text_from_pdf(pdf_file):
+    """
+    Extracts text from an uploaded PDF file object using Google Cloud Vision API.
+    The upload is read only here, so its bytes are held in memory just for the OCR call;
+    large or long PDFs are streamed to the asynchronous GCS-backed API when OCR_GCS_BUCKET
+    is set, and otherwise sent inline a few pages at a time.
+    """
+    try:
+        pdf_size = pdf_file.seek(0, os.SEEK_END)
+        pdf_file.seek(0)
+        use_gcs = OCR_GCS_BUCKET and pdf_size > ASYNC_OCR_MIN_BYTES
+        if not use_gcs:
+            pdf_content = pdf_file.read()
+            pdf_file.seek(0)
+            page_count = _pdf_page_count(pdf_content)
+            use_gcs = OCR_GCS_BUCKET and page_count > INLINE_OCR_MAX_PAGES
+        if use_gcs:
+            page_texts = _extract_page_texts_via_gcs(pdf_file)
+        else:
+            page_texts = _extract_page_texts_inline(pdf_content, page_count)
+        logger.info("Finished OCR for PDF content.")
+        return normalize_text(''.join(page_texts))
+    except Exception as e:
+        logger.error(f"Error during OCR with Google Cloud Vision: {e}")
+        raise
+
+def _pdf_page_count(pdf_content):
+    """Returns the PDF's page count, or 0 if PyMuPDF cannot open it (Vision may still manage)."""
+    try:
+        with pymupdf.open(stream=pdf_content, filetype='pdf') as doc:
+            return doc.page_count
+    except Exception as e:
+        logger.warning(f"Could not count PDF pages, OCR'ing the first {INLINE_OCR_MAX_PAGES}: {e}")
+        return 0
+
+def _extract_page_texts_inline(pdf_content, page_count):
+    """
+    Runs synchronous Vision OCR with the PDF bytes sent inline in the request. Each request
+    only covers INLINE_OCR_MAX_PAGES pages, so longer PDFs are cut into documents of that
+    many pages, which are OCR'd concurrently and each carry only their own pages. With an
+    unknown page count Vision's default (the first pages) is used.
+    """
     logger.info("Starting OCR for PDF content.")
+    if page_count <= INLINE_OCR_MAX_PAGES:
+        return _annotate_pdf_inline(pdf_content)
+    parts = _split_pdf(pdf_content, INLINE_OCR_MAX_PAGES)
+    with ThreadPoolExecutor(max_workers=min(len(parts), VISION_MAX_CONCURRENCY)) as executor:
+        return list(chain.from_iterable(executor.map(_annotate_pdf_inline, parts)))
+
+def _split_pdf(pdf_content, pages_per_part):
+    """Splits a PDF into standalone PDFs of at most `pages_per_part` pages each, in page order."""
+    parts = []
+    with pymupdf.open(stream=pdf_content, filetype='pdf') as doc:
+        for first_page in range(0, doc.page_count, pages_per_part):
+            with pymupdf.open() as part:
+                last_page = min(first_page + pages_per_part, doc.page_count) - 1
+                part.insert_pdf(doc, from_page=first_page, to_page=last_page)
+                parts.append(part.tobytes(garbage=1))
+    return parts
+
+def _annotate_pdf_inline(pdf_content):
+    """Sends one PDF to the synchronous Vision API, holding a Vision slot only for the call."""
     request = {
         'input_config': {
             'content': pdf_content,
@@ -266,38 +765,275 @@ def extract_text_from_pdf(pdf_content):
         },
         'features': [{'type_': vision.Feature.Type.DOCUMENT_TEXT_DETECTION}],
     }
+    with _vision_slots:
+        response = get_vision_client().batch_annotate_files(requests=[request])
+    return [
+        page_response.full_text_annotation.text
+        for page_response in response.responses[0].responses
+    ]
+
+def _extract_page_texts_via_gcs(pdf_file):
+    """
+    Runs asynchronous Vision OCR on a PDF staged in OCR_GCS_BUCKET.
+    Vision processes the pages in parallel on its side and writes JSON result shards
+    back to the bucket; the staged input and the shards are deleted afterwards.
+    """
+    bucket = get_storage_client().bucket(OCR_GCS_BUCKET)
+    job_prefix = f"ocr/{uuid.uuid4().hex}/"
+    output_prefix = f"{job_prefix}output/"
+    input_blob = bucket.blob(f"{job_prefix}input.pdf")
+    logger.info(f"Starting async OCR for PDF content via gs://{OCR_GCS_BUCKET}/{job_prefix}")
+    input_blob.upload_from_file(pdf_file, content_type='application/pdf')
 
     try:
-        response = vision_client.batch_annotate_files(requests=[request])
-        full_text = "".join([
-            page_response.full_text_annotation.text
-            for page_response in response.responses[0].responses
-        ])
-        logger.info("Finished OCR for PDF content.")
-        return re.sub(r'\s+', ' ', full_text).strip()
+        request = {
+            'input_config': {
+                'gcs_source': {'uri': f"gs://{OCR_GCS_BUCKET}/{input_blob.name}"},
+                'mime_type': 'application/pdf'
+            },
+            'features': [{'type_': vision.Feature.Type.DOCUMENT_TEXT_DETECTION}],
+            'output_config': {
+                'gcs_destination': {'uri': f"gs://{OCR_GCS_BUCKET}/{output_prefix}"},
+                'batch_size': ASYNC_OCR_PAGES_PER_SHARD
+            },
+        }
+        # The slot covers submitting the job; waiting on it does not use a Vision request
+        with _vision_slots:
+            operation = get_vision_client().async_batch_annotate_files(requests=[request])
+        operation.result(timeout=ASYNC_OCR_TIMEOUT)
+
+        # Shards are named output-<first page>-to-<last page>.json; read them in page order
+        shards = sorted(
+            bucket.list_blobs(prefix=output_prefix),
+            key=lambda blob: int(_OCR_SHARD_RE.search(blob.name).group(1))
+        )
+        page_texts = []
+        for shard in shards:
+            shard_data = orjson.loads(shard.download_as_bytes())
+            page_texts.extend(
+                page_response.get('fullTextAnnotation', {}).get('text', '')
+                for page_response in shard_data.get('responses', [])
+            )
+        return page_texts
+    finally:
+        for blob in bucket.list_blobs(prefix=job_prefix):
+            blob.delete()
+
+@cache
+def get_gemini_model():
+    """Returns the shared Gemini model, bound to the system instruction."""
+    return genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=SYSTEM_INSTRUCTION)
+
+@content_cache('pdf', _pdf_cache_key)
+def extract_pdf_content(pdf_file):
+    """
+    Reads one uploaded PDF for the upload pipeline and returns (parsed_data, text_content)
+    with exactly one side set. In 'auto' PDF_HANDLING mode a born-digital PDF whose text
+    layer parses confidently is returned as line items directly, skipping OCR and Gemini;
+    anything else (scans, unusual layouts, 'vision' mode) is OCR'd for Gemini.
+    The result is cached by file hash, so a repeated upload is hashed once and neither
+    parsed nor OCR'd again.
+    """
+    if PDF_HANDLING == 'auto':
+        parsed_data = parse_financial_data_locally(pdf_file)
+        pdf_file.seek(0)
+        if parsed_data:
+            return parsed_data, None
+    return None, extract_text_from_pdf(pdf_file)
+
+def parse_financial_data_locally(pdf_file):
+    """
+    Parses line items from a PDF's embedded text layer without any API calls.
+    Lines are read under the most recent year header ("... 2023 2022") and must end in one
+    amount per year, optionally preceded by a note number. Returns the items in the same
+    shape Gemini produces, or None when there is no text layer or fewer than
+    LOCAL_PARSE_MIN_CONFIDENCE of the numeric lines fit that layout.
+    """
+    try:
+        with pymupdf.open(stream=pdf_file.read(), filetype='pdf') as doc:
+            rows = [row for page in doc for row in _text_layer_rows(page)]
     except Exception as e:
-        logger.error(f"Error during OCR with Google Cloud Vision: {e}")
+        logger.warning(f"Could not read PDF text layer, falling back to OCR: {e}")
+        return None
+
+    years = None
+    year_centres = None
+    parsed_data = []
+    numeric_lines = 0
+    for row in rows:
+        line = ' '.join(word[4] for word in row)
+        header_years = _year_header(line)
+        if header_years:
+            years = header_years
+            year_centres = [(word[0] + word[2]) / 2 for word in row[-len(years):]]
+            continue
+        if years is None or not _AMOUNT_RE.search(line):
+            continue
+
+        numeric_lines += 1
+        statement_row = _statement_row(row, year_centres)
+        if statement_row is None:
+            continue
+        description, amounts = statement_row
+        parsed_data.append({
+            "Description": description,
+            "AmountsByYear": dict(zip(years, amounts))
+        })
+
+    if len(parsed_data) < LOCAL_PARSE_MIN_ROWS or len(parsed_data) < LOCAL_PARSE_MIN_CONFIDENCE * numeric_lines:
+        return None
+    return parsed_data
+
+def _text_layer_rows(page):
+    """
+    Rebuilds a page's lines from PyMuPDF word boxes: words sharing a baseline form one row,
+    as (x0, y0, x1, y1, text) tuples ordered left to right.
+    """
+    rows = []
+    for word in sorted(page.get_text("words"), key=lambda word: word[3]):
+        height = word[3] - word[1]
+        if rows and word[3] - rows[-1][-1][3] <= height * LOCAL_LINE_TOLERANCE:
+            rows[-1].append(word)
+        else:
+            rows.append([word])
+
+    for row in rows:
+        row.sort(key=lambda word: word[0])
+        # Dashes/minus signs are folded so en-dash nil markers match _LOCAL_AMOUNT_RE
+        row[:] = [(*word[:4], word[4].translate(_PUNCTUATION_TABLE)) for word in row]
+    return rows
+
+def _statement_row(row, year_centres):
+    """
+    Splits a statement row into (description, amounts), or returns None. The amounts are the
+    amount-like words ending the row (at most LOCAL_MAX_AMOUNT_TOKENS), grouped into visible
+    columns by the gaps between them; optionally after a note reference, there must be one
+    column under each header year. Rows with fewer columns than years are rejected rather
+    than guessed at, so they count against the parse confidence and the file goes to Gemini.
+    """
+    start = len(row)
+    while start and _LOCAL_AMOUNT_TOKEN_RE.fullmatch(row[start - 1][4]):
+        start -= 1
+        if len(row) - start > LOCAL_MAX_AMOUNT_TOKENS:
+            return None
+    if start in (0, len(row)):
+        return None
+    description = ' '.join(word[4] for word in row[:start])
+    if _DIGIT_RE.search(description) or not _LOCAL_DESCRIPTION_RE.search(description):
+        return None
+
+    columns = _layout_columns(row[start:])
+    if len(columns) == len(year_centres) + 1 and _NOTE_REF_RE.fullmatch(columns[0][0]):
+        columns = columns[1:]
+    if len(columns) != len(year_centres):
+        return None
+    tolerance = min(abs(right - left) for left, right in zip(year_centres, year_centres[1:])) / 2
+    for (text, centre), year_centre in zip(columns, year_centres):
+        if not _LOCAL_AMOUNT_RE.fullmatch(text) or abs(centre - year_centre) > tolerance:
+            return None
+    return description, [text for text, _ in columns]
+
+def _layout_columns(words):
+    """
+    Groups adjacent words into (text, x-centre) columns. A gap wider than LOCAL_COLUMN_GAP of
+    the word height starts a new column; narrower gaps are thousands separators ("1 234").
+    """
+    columns = [[words[0]]]
+    for previous, word in zip(words, words[1:]):
+        if word[0] - previous[2] > (word[3] - word[1]) * LOCAL_COLUMN_GAP:
+            columns.append([word])
+        else:
+            columns[-1].append(word)
+    return [
+        (' '.join(word[4] for word in column), (column[0][0] + column[-1][2]) / 2)
+        for column in columns
+    ]
+
+def _year_header(line):
+    """
+    Returns the years of a column header line (e.g. ["2023", "2022"]), or None. The line must
+    end in at least two consecutive years in descending order, preceded only by header words,
+    so a data row ending in year-like amounts ("Bank charges 2015 1987") is not mistaken
+    for a new header.
+    """
+    tokens = line.split()
+    first_year = len(tokens)
+    while first_year and _YEAR_TOKEN_RE.fullmatch(tokens[first_year - 1]):
+        first_year -= 1
+    years = tokens[first_year:]
+    if len(years) < 2 or any(int(newer) - int(older) != 1 for newer, older in zip(years, years[1:])):
+        return None
+    if not all(_YEAR_HEADER_WORD_RE.fullmatch(token) for token in tokens[:first_year]):
+        return None
+    return years
+
+def split_financial_sections(text_content):
+    """
+    Splits OCR text at financial statement and notes headings and keeps only the
+    sections dense enough in numbers to hold line items. Kept sections are packed
+    into chunks of at most GEMINI_SECTION_CHUNK_CHARS so long reports are parsed in
+    parallel with fewer input tokens. Falls back to the whole text if nothing matches.
+    """
+    starts = [match.start() for match in _SECTION_RE.finditer(text_content)]
+    if not starts:
+        return [text_content]
+    if starts[0] != 0:
+        starts.insert(0, 0)
+    bounds = starts + [len(text_content)]
+    sections = [
+        section for section in (text_content[start:end] for start, end in zip(bounds, bounds[1:]))
+        if len(_AMOUNT_RE.findall(section)) >= MIN_SECTION_AMOUNTS
+    ]
+    if not sections:
+        return [text_content]
+
+    chunks = [sections[0]]
+    for section in sections[1:]:
+        if len(chunks[-1]) + len(section) <= GEMINI_SECTION_CHUNK_CHARS:
+            chunks[-1] += section
+        else:
+            chunks.append(section)
+    return chunks
+
+def merge_section_results(section_results):
+    """
+    Combines the line items parsed from each section of one document, dropping malformed
+    items. Every item is kept, so repeated descriptions are summed during consolidation
+    exactly as when the whole document was parsed in one call, however the sections
+    happened to be packed into chunks.
+    """
+    return [
+        item for parsed_data in section_results for item in parsed_data
+        if isinstance(item, dict) and 'Description' in item and isinstance(item.get('AmountsByYear'), dict)
+    ]
+
+def _generate_gemini_json(prompt):
+    """Sends one prompt to the shared Gemini model and returns the decoded JSON response."""
+    response = get_gemini_model().generate_content(
+        prompt,
+        generation_config={"response_mime_type": "application/json"},
+        request_options={"retry": GEMINI_RETRY, "timeout": GEMINI_REQUEST_TIMEOUT}
+    )
+
+    # Strip any markdown code fence so the response is valid JSON
+    cleaned_text = response.text.strip().removeprefix('```json').removeprefix('```').removesuffix('```').strip()
+    try:
+        return orjson.loads(cleaned_text)
+    except orjson.JSONDecodeError:
+        # Log the raw response for debugging
+        logger.error(f"Raw Gemini response: {response.text}")
         raise
 
+@content_cache('gemini', _gemini_cache_key)
 def parse_financial_data_with_gemini(text_content, filename, custom_prompt_text=""):
-    """Uses Gemini API to parse financial text and return structured JSON."""
+    """
+    Uses Gemini API to parse financial text and return structured JSON. API and JSON errors
+    are raised, so the caller can report the file as failed.
+    """
     logger.info(f"Sending text from {filename} to Gemini API for financial data parsing.")
     if not GEMINI_API_KEY:
         raise ValueError("GEMINI_API_KEY is not set.")
 
-    model = genai.GenerativeModel('gemini-1.5-flash-latest')
-
-    system_instruction = """
-    You are an expert financial data extractor. Your task is to extract all financial line items and their corresponding numerical values from the provided text.
-    - The output must be a valid JSON array of objects.
-    - Each object must have two keys: "Description" (string) and "AmountsByYear" (an object).
-    - The "AmountsByYear" object should have years as keys (e.g., "2023") and numerical values as values.
-    - Parse numbers correctly: remove currency symbols, commas, and handle parentheses for negative numbers. Treat spaces as thousand separators (e.g., "1 234" is 1234).
-    - Do NOT calculate or infer any values. Only extract what is explicitly present in the text.
-    - Extract data from all sections, including main statements and notes.
-    - Example output format: [{"Description": "Revenue", "AmountsByYear": {"2023": 500000, "2022": 450000}}]
-    """
-
     prompt = f"""
     {custom_prompt_text}
 
@@ -307,101 +1043,119 @@ def parse_financial_data_with_gemini(text_content, filename, custom_prompt_text=
     ---
     """
     
+    parsed_data = _generate_gemini_json(prompt)
+    if not isinstance(parsed_data, list):
+        logger.warning(f"Gemini returned non-list data for {filename}: {type(parsed_data)}")
+        return []
+
+    logger.info(f"Successfully parsed data from {filename} using Gemini.")
+    return parsed_data
+
+def parse_financial_documents_with_gemini(documents, custom_prompt_text=""):
+    """
+    Parses several small documents, given as (filename, text) pairs, with a single Gemini
+    call and returns one item list per document, in order. Documents missing from the
+    batched response (or all of them, if the batched call fails) are parsed individually;
+    a document whose individual call fails gets the raised exception in place of its items.
+    """
+    filenames = ", ".join(filename for filename, _ in documents)
+    logger.info(f"Sending {len(documents)} documents ({filenames}) to Gemini API in one request.")
     try:
-        response = model.generate_content(
-            prompt,
-            generation_config={"response_mime_type": "application/json"},
-            system_instruction=system_instruction
-        )
-        
-        # Clean the response text to ensure it's valid JSON
-        cleaned_text = response.text.strip()
-        if cleaned_text.startswith("```json"):
-            cleaned_text = cleaned_text[7:]
-        if cleaned_text.endswith("```"):
-            cleaned_text = cleaned_text[:-3]
-
-        parsed_data = json.loads(cleaned_text)
-        
+        batch = _parse_document_batch_with_gemini([text for _, text in documents], custom_prompt_text)
+    except Exception as e:
+        logger.error(f"Batched Gemini call failed for {filenames}, parsing them individually: {e}")
+        batch = {}
+
+    results = []
+    for number, (filename, text) in enumerate(documents, 1):
+        parsed_data = batch.get(str(number))
         if not isinstance(parsed_data, list):
-            logger.warning(f"Gemini returned non-list data for {filename}: {type(parsed_data)}")
-            return []
-            
-        logger.info(f"Successfully parsed data from {filename} using Gemini.")
-        return parsed_data
+            try:
+                parsed_data = parse_financial_data_with_gemini(text, filename, custom_prompt_text)
+            except Exception as e:
+                logger.error(f"Error during Gemini API call or JSON parsing for {filename}: {e}")
+                parsed_data = e
+        results.append(parsed_data)
+    return results
 
-    except Exception as e:
-        logger.error(f"Error during Gemini API call or JSON parsing for {filename}: {e}")
-        # Log the raw response if available for debugging
-        if 'response' in locals() and hasattr(response, 'text'):
-            logger.error(f"Raw Gemini response: {response.text}")
-        return []
+@content_cache('gemini-batch', _gemini_batch_cache_key)
+def _parse_document_batch_with_gemini(texts, custom_prompt_text=""):
+    """Returns {document number: line items} for a numbered batch of documents."""
+    if not GEMINI_API_KEY:
+        raise ValueError("GEMINI_API_KEY is not set.")
+
+    documents = "\n".join(f"=== DOCUMENT {number} ===\n{text}" for number, text in enumerate(texts, 1))
+    prompt = f"""
+    {custom_prompt_text}
+
+    The text below contains {len(texts)} separate documents, each starting with a line "=== DOCUMENT <number> ===".
+    Extract the financial data from each document separately. Return one JSON object that maps each
+    document number (as a string, e.g. "1") to the list of line items for that document.
+    ---
+    {documents}
+    ---
+    """
+    parsed_data = _generate_gemini_json(prompt)
+    if not isinstance(parsed_data, dict):
+        logger.warning(f"Gemini returned non-object data for a document batch: {type(parsed_data)}")
+        return {}
+    return parsed_data
 
 def generate_excel_report(all_items, all_years):
-    """Generates an Excel workbook from the consolidated financial data."""
+    """
+    Generates an Excel workbook from the consolidated financial data.
+    The workbook is write-only, so rows are streamed to XML as they are appended
+    instead of being held as a grid of cell objects.
+    """
     logger.info("Generating Excel report...")
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Financials"
-
-    # --- Define Styles ---
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
-    category_font = Font(bold=True)
-    subcategory_font = Font(bold=True)
-    total_font = Font(bold=True)
-    total_border = Border(bottom=Side(style='thin'), top=Side(style='thin'))
-    currency_format = '_(* #,##0.00_);_(* (#,##0.00);_(* "-"??_);_(@_)'
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Financials")
+
+    for style_name, attributes in _NAMED_STYLE_SPECS:
+        wb.add_named_style(NamedStyle(name=style_name, **attributes))
+
+    def styled_cell(value, style_name):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style_name
+        return cell
 
     # --- Write Headers ---
-    headers = ["Description"] + [str(year) for year in all_years]
-    ws.append(headers)
-    for col_idx, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_idx)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = Alignment(horizontal='center')
+    # Column widths must be set before the first row is written in write-only mode.
+    # Year keys are converted to strings once and reused for the header and every data row
+    year_keys = tuple(str(year) for year in all_years)
+    headers = ("Description",) + year_keys
+    for col_idx in range(1, len(headers) + 1):
         ws.column_dimensions[get_column_letter(col_idx)].width = 20 if col_idx > 1 else 50
-    
-    # --- Write Data ---
-    row_idx = 2
-    for category, subcategories in MASTER_STRUCTURE.items():
-        # Write main category header
-        ws.cell(row=row_idx, column=1, value=category).font = category_font
-        row_idx += 1
-
-        for subcategory, items in subcategories.items():
-            # Write subcategory header if it's not 'N/A'
-            if subcategory != "N/A":
-                ws.cell(row=row_idx, column=1, value=subcategory).font = subcategory_font
-                ws.cell(row=row_idx, column=1).alignment = Alignment(indent=1)
-                row_idx += 1
+    ws.append([styled_cell(header, 'fin_header') for header in headers])
 
-            for item_name in items:
-                if item_name in all_items:
-                    item_data = all_items[item_name]
-                    ws.cell(row=row_idx, column=1, value=item_name).alignment = Alignment(indent=2)
-                    for col_idx, year in enumerate(all_years, 2):
-                        cell = ws.cell(row=row_idx, column=col_idx)
-                        cell.value = item_data.get(str(year))
-                        cell.number_format = currency_format
-                    
-                    # Apply total styling for 'Total' rows
-                    if "total" in item_name.lower():
-                        for col_idx in range(1, len(headers) + 1):
-                            ws.cell(row=row_idx, column=col_idx).font = total_font
-                            ws.cell(row=row_idx, column=col_idx).border = total_border
-                    
-                    row_idx += 1
-        
-        # Add a blank row between major categories for readability
-        row_idx += 1
+    # --- Write Data ---
+    append_row = ws.append
+    get_item_data = all_items.get
+    for kind, label_style, value_style, name in _ROW_PLAN:
+        if kind == _ITEM_ROW:
+            item_data = get_item_data(name)
+            if item_data is None:
+                continue
+            append_row(
+                [styled_cell(name, label_style)]
+                + [styled_cell(item_data.get(year_key), value_style) for year_key in year_keys]
+            )
+        elif kind == _BLANK_ROW:
+            append_row([])
+        else:
+            append_row([styled_cell(name, label_style)])
 
     logger.info("Excel report generated successfully.")
     return wb
 
 # --- Flask API Routes ---
 
+def has_pdf_signature(pdf_file):
+    """Checks the start of an upload for the PDF header, leaving the stream rewound."""
+    head = pdf_file.read(PDF_SIGNATURE_WINDOW)
+    pdf_file.seek(0)
+    return PDF_SIGNATURE in head
+
 @app.route('/upload-and-convert', methods=['POST'])
 def upload_and_convert_pdfs():
     """
@@ -414,84 +1168,206 @@ def upload_and_convert_pdfs():
     if not files or all(f.filename == '' for f in files):
         return jsonify({"error": "No selected files"}), 400
 
+    # Non-PDF uploads are dropped before any work is scheduled for them
+    pdf_files = [
+        file for file in files
+        if file and os.path.splitext(file.filename)[1].lower() in PDF_EXTENSIONS
+    ]
+    if not pdf_files:
+        return jsonify({"error": "No PDF files were uploaded."}), 400
+
     custom_prompt_text = request.form.get('prompt', '')
-    all_extracted_data = []
-    all_years = set()
 
-    for file in files:
-        if file and file.filename.lower().endswith('.pdf'):
+    # OCR and Gemini parsing are both network-bound. Each runs on its own bounded pool
+    # (Vision takes one file per call; Gemini is rate limited), and a file's sections are
+    # queued for Gemini as soon as its OCR finishes, so parsing of early files overlaps
+    # OCR of later ones. Small documents are batched only once all OCR is done, in upload
+    # order, so an identical upload always yields identical batches and cached responses.
+    # Upload streams are passed through as Werkzeug spools large ones to disk.
+    logger.info(f"Processing {len(pdf_files)} file(s).")
+    local_results = [None] * len(pdf_files)
+    section_futures = [None] * len(pdf_files)
+    # A mislabelled .pdf is caught by its header, so it is never hashed, parsed or sent to
+    # OCR, but it is still reported as failed.
+    failed_files = [
+        None if has_pdf_signature(file.stream) else f"{file.filename}: not a valid PDF file"
+        for file in pdf_files
+    ]
+    batch_slots = [None] * len(pdf_files)
+    small_documents = [None] * len(pdf_files)
+    pending_batch = []
+    file_results = []
+    processing_error = False
+    ocr_workers = max(1, min(OCR_WORKERS, len(pdf_files)))
+    with ThreadPoolExecutor(max_workers=ocr_workers) as ocr_executor, \
+            ThreadPoolExecutor(max_workers=GEMINI_MAX_CONCURRENCY) as gemini_executor:
+        def submit_pending_batch():
+            if len(pending_batch) == 1:
+                index, text = pending_batch[0]
+                section_futures[index] = [gemini_executor.submit(
+                    parse_financial_data_with_gemini, text, pdf_files[index].filename, custom_prompt_text
+                )]
+            else:
+                batch_future = gemini_executor.submit(
+                    parse_financial_documents_with_gemini,
+                    [(pdf_files[index].filename, text) for index, text in pending_batch],
+                    custom_prompt_text
+                )
+                for position, (index, _) in enumerate(pending_batch):
+                    batch_slots[index] = (batch_future, position)
+            pending_batch.clear()
+
+        ocr_futures = {
+            ocr_executor.submit(extract_pdf_content, file.stream): index
+            for index, file in enumerate(pdf_files)
+            if failed_files[index] is None
+        }
+        for ocr_future in as_completed(ocr_futures):
+            index = ocr_futures[ocr_future]
+            filename = pdf_files[index].filename
+            try:
+                local_data, text_content = ocr_future.result()
+            except Exception as e:
+                logger.error(f"Failed to extract text from {filename}: {e}")
+                failed_files[index] = f"{filename}: {e}"
+                processing_error = True
+                continue
+            finally:
+                # The upload is not read again; closing it releases its spooled temp file (or
+                # in-memory buffer) now instead of when the whole request ends.
+                pdf_files[index].close()
+            if local_data:
+                logger.info(f"Parsed {filename} from its text layer; skipping OCR and Gemini.")
+                local_results[index] = local_data
+                continue
+            if not text_content:
+                logger.warning(f"Could not extract text from {filename}")
+                failed_files[index] = f"{filename}: no text could be extracted"
+                continue
+            sections = split_financial_sections(text_content)
+            if len(sections) == 1 and len(sections[0]) <= GEMINI_BATCH_DOC_MAX_CHARS:
+                small_documents[index] = sections[0]
+                continue
+            section_futures[index] = [
+                gemini_executor.submit(parse_financial_data_with_gemini, section, filename, custom_prompt_text)
+                for section in sections
+            ]
+
+        # Small documents share Gemini calls; each batch is sent once it is full
+        for index, text in enumerate(small_documents):
+            if text is None:
+                continue
+            if pending_batch and (
+                len(pending_batch) == GEMINI_BATCH_MAX_DOCS
+                or sum(len(batched) for _, batched in pending_batch) + len(text) > GEMINI_SECTION_CHUNK_CHARS
+            ):
+                submit_pending_batch()
+            pending_batch.append((index, text))
+        if pending_batch:
+            submit_pending_batch()
+
+        # Merge in upload order so the consolidated output does not depend on timing
+        for index, (file, local_data, futures, batch_slot) in enumerate(
+                zip(pdf_files, local_results, section_futures, batch_slots)):
+            if local_data is None and futures is None and batch_slot is None:
+                continue
             try:
                 logger.info(f"Processing file: {file.filename}")
-                pdf_content = file.read()
-                text_content = extract_text_from_pdf(pdf_content)
-                
-                if text_content:
-                    parsed_data = parse_financial_data_with_gemini(text_content, file.filename, custom_prompt_text)
-                    if parsed_data:
-                        all_extracted_data.extend(parsed_data)
-                        for item in parsed_data:
-                            if 'AmountsByYear' in item and isinstance(item['AmountsByYear'], dict):
-                                all_years.update(item['AmountsByYear'].keys())
+                if local_data:
+                    parsed_data = local_data
+                elif batch_slot:
+                    batch_future, position = batch_slot
+                    batch_result = batch_future.result()[position]
+                    if isinstance(batch_result, Exception):
+                        raise batch_result
+                    parsed_data = merge_section_results([batch_result])
                 else:
-                    logger.warning(f"Could not extract text from {file.filename}")
-
+                    parsed_data = merge_section_results([future.result() for future in futures])
+                if parsed_data:
+                    file_results.append(parsed_data)
+                else:
+                    logger.warning(f"No financial data was extracted from {file.filename}")
+                    failed_files[index] = f"{file.filename}: no financial data was extracted"
             except Exception as e:
                 logger.error(f"Failed to process file {file.filename}: {e}")
-                return jsonify({"error": f"An error occurred while processing {file.filename}: {str(e)}"}), 500
-    
+                failed_files[index] = f"{file.filename}: {e}"
+                processing_error = True
+
+    # One bad PDF no longer aborts the batch: the others are still converted and the
+    # failures (including files that yielded no data) are reported alongside the workbook,
+    # or instead of it if nothing worked.
+    failures = [failure for failure in failed_files if failure is not None]
+    all_extracted_data = list(chain.from_iterable(file_results))
     if not all_extracted_data:
-        return jsonify({"error": "Could not extract any financial data from the provided files."}), 400
+        if processing_error:
+            return jsonify({"error": f"An error occurred while processing {'; '.join(failures)}"}), 500
+        return jsonify({"error": f"Could not extract any financial data from {'; '.join(failures)}"}), 400
 
     # --- Data Consolidation and Cleaning ---
-    sorted_years = sorted(list(all_years), reverse=True)
-    consolidated_items = {}
+    all_years = set().union(*(
+        item['AmountsByYear'].keys() for item in all_extracted_data
+        if isinstance(item.get('AmountsByYear'), dict)
+    ))
+    sorted_years = tuple(sorted(all_years, reverse=True))
+    consolidated_items = defaultdict(lambda: defaultdict(float))
 
     for item in all_extracted_data:
         if 'Description' not in item or 'AmountsByYear' not in item:
             continue
         
-        canonical_name = get_canonical_name(item['Description'])
-        if canonical_name not in consolidated_items:
-            consolidated_items[canonical_name] = {}
-        
+        # Indexing creates the entry even if none of its values are usable, so the row still appears
+        item_amounts = consolidated_items[get_canonical_name(item['Description'])]
         for year, value in item['AmountsByYear'].items():
             cleaned_val = clean_value(value)
             if cleaned_val is not None:
-                # If the key already exists, sum the values (handles duplicates)
-                consolidated_items[canonical_name][year] = consolidated_items[canonical_name].get(year, 0) + cleaned_val
-
-    # Post-processing for Accumulated Surplus/Deficit
-    for year in sorted_years:
-        surplus = consolidated_items.get("Accumulated surplus", {}).get(year)
-        deficit = consolidated_items.get("Accumulated deficit", {}).get(year)
-        if surplus is not None and deficit is not None:
-            if surplus > 0 and deficit < 0:
-                # Both exist, decide which one to keep. Let's assume surplus is the primary.
-                # Ensure the key exists before attempting to delete
-                if year in consolidated_items["Accumulated deficit"]:
-                    del consolidated_items["Accumulated deficit"][year]
-            elif deficit != 0:
-                consolidated_items["Accumulated surplus"][year] = deficit
-                if year in consolidated_items["Accumulated deficit"]:
-                    del consolidated_items["Accumulated deficit"][year]
+                # Sum values for repeated descriptions (handles duplicates)
+                item_amounts[year] += cleaned_val
+
+    # Post-processing for Accumulated Surplus/Deficit: only years present in both need reconciling
+    surplus_amounts = consolidated_items.get("Accumulated surplus", {})
+    deficit_amounts = consolidated_items.get("Accumulated deficit", {})
+    for year in surplus_amounts.keys() & deficit_amounts.keys():
+        # A non-zero deficit is folded into the surplus row: a positive surplus wins over a
+        # negative deficit, otherwise the deficit replaces it. A zero deficit is left as is.
+        deficit = deficit_amounts[year]
+        if deficit:
+            if not surplus_amounts[year] > 0 > deficit:
+                surplus_amounts[year] = deficit
+            del deficit_amounts[year]
 
 
     # --- Excel Generation ---
+    output_path = None
     try:
         workbook = generate_excel_report(consolidated_items, sorted_years)
-        output_io = io.BytesIO()
-        workbook.save(output_io)
-        output_io.seek(0)
-        
-        return send_file(
-            output_io,
+        # Sent from a named file on disk so the WSGI server's file wrapper can use sendfile(2)
+        # rather than copying the body through Python. send_file has opened the file by the time
+        # it returns, so the name is unlinked straight away (call_on_close never fires for
+        # direct-passthrough file responses); the data stays readable until the handle closes.
+        with tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False) as output_file:
+            output_path = output_file.name
+            workbook.save(output_file)
+        response = send_file(
+            output_path,
             as_attachment=True,
             download_name='consolidated_financials.xlsx',
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+            conditional=True,
+            etag=True
         )
+        if failures:
+            response.headers[FAILED_FILES_HEADER] = ','.join(
+                quote(file.filename) for file, failure in zip(pdf_files, failed_files) if failure
+            )
+        return response
     except Exception as e:
         logger.error(f"Failed to generate Excel file: {e}")
         return jsonify({"error": "Failed to generate the Excel file."}), 500
+    finally:
+        # Also runs when saving or sending fails, so no temporary workbook is left behind
+        if output_path:
+            with suppress(FileNotFoundError):
+                os.unlink(output_path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,16 @@
+# Gunicorn settings for the Procfile's web process; gunicorn loads this file from the
+# working directory automatically and binds to $PORT when it is set.
+import os
+
+# An upload spends nearly all of its time waiting on Vision and Gemini, so threaded
+# workers let concurrent uploads overlap instead of queueing behind each other.
+worker_class = "gthread"
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+# Import the app once in the master and fork workers from it. The Vision/Storage clients
+# and the Gemini model are created lazily, so no gRPC channel is shared across the fork.
+preload_app = True
+
+# Reuse client connections briefly (the frontend often posts again right after a download).
+keepalive = 5